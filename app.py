@@ -1,13 +1,21 @@
 from flask import Flask, request, abort
+from waitress import serve
+from cachetools import TTLCache
 import subprocess
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
 import os
+import pwd
 import threading
+import concurrent.futures
+import queue
 import hmac
 import hashlib
 import time
 import re
+import shutil
+import collections
 
 app = Flask(__name__)
 
@@ -46,20 +54,180 @@ claude_lock = threading.Lock()
 claude_process_count = 0
 MAX_CLAUDE_PROCESSES = 5
 
-# Track Claude session IDs, git branches, and worktree paths per Slack thread
-# Key: thread_ts, Value: {"session_id": str, "branch": str, "worktree_path": str}
-thread_sessions = {}
+# Request-handling threads for the WSGI server. Handlers only verify, parse and
+# hand off work, so a small pool is enough to keep Slack retries from queueing.
+HTTP_THREADS = 8
+
+# Verified Slack events waiting for the dispatcher thread
+EVENT_QUEUE = queue.SimpleQueue()
+
+# Built-in commands run git and can take minutes, so they get their own pool
+# rather than holding up the dispatcher or a Claude slot. A single worker keeps
+# them serialized, so e.g. !update and !branch never run git on the shared
+# repo at the same time.
+COMMAND_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="command"
+)
+
+# Claude jobs run on a fixed pool instead of a fresh thread per message.
+# Admission is capped at MAX_CLAUDE_PROCESSES, so jobs never queue here.
+WORKER_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=MAX_CLAUDE_PROCESSES, thread_name_prefix="claude"
+)
 
 # Prevent concurrent Claude runs in the same thread (they'd share a worktree)
 active_threads = set()
 active_threads_lock = threading.Lock()
 
-def get_current_branch(cwd):
-    """Get the current git branch in the given directory."""
-    result = subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "branch", "--show-current"],
-        capture_output=True, text=True, cwd=cwd
+# Threads idle this long are forgotten, and at most this many are tracked
+THREAD_SESSION_TTL = 24 * 3600
+MAX_THREAD_SESSIONS = 1024
+
+class ThreadSessionCache(TTLCache):
+    """TTLCache that releases a thread's resources when its entry is dropped.
+
+    Entries leave either by expiring (no activity for THREAD_SESSION_TTL) or
+    by being the least recently used when the cache is full.
+    """
+
+    def popitem(self):
+        thread_ts, info = super().popitem()
+        release_thread(thread_ts, info)
+        return thread_ts, info
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for thread_ts, info in expired:
+            release_thread(thread_ts, info)
+        return expired
+
+def release_thread(thread_ts, info):
+    """Close a dropped thread's Claude process and remove its worktree.
+
+    Called with sessions_lock held, so the slow part runs in the background.
+    The thread is claimed in active_threads for the whole release, so a new
+    run or !branch can't rebuild the worktree while it is being removed.
+    """
+    def _release():
+        with active_threads_lock:
+            if thread_ts in active_threads:
+                return  # the running job will store the session again
+            active_threads.add(thread_ts)
+        try:
+            with sessions_lock:
+                if thread_ts in thread_sessions:
+                    return  # the thread came back (e.g. !branch) before we ran
+            close_claude_session(thread_ts)
+            if info.get("worktree_path"):
+                print(f"Removing worktree for expired thread {thread_ts}")
+                remove_worktree(thread_ts)
+        finally:
+            with active_threads_lock:
+                active_threads.discard(thread_ts)
+
+    threading.Thread(target=_release, daemon=True).start()
+
+# Track Claude session IDs, git branches, and worktree paths per Slack thread
+# Key: thread_ts, Value: {"session_id": str, "branch": str, "worktree_path": str}
+# Values are replaced wholesale, never mutated; hold sessions_lock for any access.
+thread_sessions = ThreadSessionCache(maxsize=MAX_THREAD_SESSIONS, ttl=THREAD_SESSION_TTL)
+sessions_lock = threading.RLock()
+
+def snapshot_thread_sessions():
+    """Return a list of (thread_ts, info) pairs copied under sessions_lock.
+
+    Callers iterate the copy outside the lock, so concurrent writers can't
+    change it mid-iteration and slow work doesn't block them. Expiring
+    first keeps entries from timing out while they are being read.
+    """
+    with sessions_lock:
+        thread_sessions.expire()
+        return list(thread_sessions.items())
+
+# Seconds before a git command or a Claude run is considered hung and killed
+GIT_TIMEOUT = 300
+CLAUDE_TIMEOUT = 30 * 60
+
+def run_git(args, cwd=None):
+    """Run a git command as CLAUDE_USER and return the CompletedProcess.
+
+    Commands that exceed GIT_TIMEOUT are killed and reported as a failure
+    (returncode -1) so a hung git can't pin a worker thread forever.
+    """
+    cmd = [*GIT_COMMAND, *args]
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        cwd=cwd or WORKSPACE_DIR, env=GIT_ENV
     )
+    try:
+        stdout, stderr = process.communicate(timeout=GIT_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        # SIGTERM first: sudo forwards it to git, whereas SIGKILL would only
+        # kill sudo and leave the hung git orphaned
+        # Wait on the process rather than its pipes, which a surviving
+        # grandchild could hold open indefinitely.
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        return subprocess.CompletedProcess(
+            cmd, -1, "", f"git {args[0]} timed out after {GIT_TIMEOUT}s"
+        )
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def read_git_head(cwd):
+    """Return the contents of HEAD for the checkout at cwd, or None if unreadable.
+
+    In the main workspace `.git` is a directory; in a worktree it is a file
+    containing `gitdir: <path>` pointing at the worktree's own git dir.
+    """
+    git_path = os.path.join(cwd, ".git")
+    try:
+        if os.path.isfile(git_path):
+            with open(git_path) as f:
+                content = f.read().strip()
+            if not content.startswith("gitdir:"):
+                return None
+            git_dir = os.path.join(cwd, content[len("gitdir:"):].strip())
+        else:
+            git_dir = git_path
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+# `git worktree prune` requests are coalesced: callers flag that a prune is
+# needed and the pruner thread runs at most one per PRUNE_INTERVAL seconds.
+PRUNE_INTERVAL = 30
+_prune_pending = threading.Event()
+_prune_lock = threading.Lock()
+
+def request_prune():
+    """Ask the background pruner to run `git worktree prune` soon."""
+    _prune_pending.set()
+
+def prune_worktrees():
+    """Run `git worktree prune` now, satisfying any pending request."""
+    with _prune_lock:
+        _prune_pending.clear()
+        run_git(["worktree", "prune"])
+
+def get_current_branch(cwd):
+    """Get the current git branch in the given directory.
+
+    Reads HEAD directly rather than forking git on every Claude run; git is
+    only consulted if HEAD can't be read.
+    """
+    head = read_git_head(cwd)
+    if head is not None:
+        # Anything other than a branch ref is a detached HEAD (a raw SHA)
+        if head.startswith("ref: refs/heads/"):
+            return head[len("ref: refs/heads/"):]
+        return DEFAULT_BRANCH
+
+    result = run_git(["branch", "--show-current"], cwd=cwd)
     branch = result.stdout.strip() if result.returncode == 0 else ""
     return branch or DEFAULT_BRANCH
 
@@ -85,23 +253,13 @@ def ensure_worktree(thread_ts, branch=None):
     # Git doesn't allow the same branch in multiple worktrees, and main is
     # already checked out in WORKSPACE_DIR. Detached HEAD is safe — Claude
     # can create/switch branches within the worktree freely.
-    result = subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "worktree", "add",
-         "--detach", worktree_path, branch],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    result = run_git(["worktree", "add", "--detach", worktree_path, branch])
 
     if result.returncode != 0:
-        # Prune stale worktree metadata and retry
-        subprocess.run(
-            ["sudo", "-u", CLAUDE_USER, "git", "worktree", "prune"],
-            capture_output=True, text=True, cwd=WORKSPACE_DIR
-        )
-        result = subprocess.run(
-            ["sudo", "-u", CLAUDE_USER, "git", "worktree", "add",
-             "--detach", worktree_path, branch],
-            capture_output=True, text=True, cwd=WORKSPACE_DIR
-        )
+        # Prune stale worktree metadata and retry. This one can't wait for
+        # the background pruner since the retry depends on it.
+        prune_worktrees()
+        result = run_git(["worktree", "add", "--detach", worktree_path, branch])
 
     if result.returncode != 0:
         raise RuntimeError(
@@ -120,11 +278,7 @@ def remove_worktree(thread_ts):
     if not os.path.isdir(worktree_path):
         return True
 
-    result = subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "worktree", "remove", "--force",
-         worktree_path],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    result = run_git(["worktree", "remove", "--force", worktree_path])
 
     if result.returncode != 0:
         print(f"Failed to remove worktree {worktree_path}: {result.stderr}")
@@ -132,37 +286,48 @@ def remove_worktree(thread_ts):
     return True
 
 def cleanup_stale_worktrees(max_age_hours=24):
-    """Remove worktrees not in thread_sessions and older than max_age_hours."""
+    """Remove worktrees not in thread_sessions and older than max_age_hours.
+
+    Expired sessions release their own worktrees; this also expires entries
+    that saw no writes since their TTL ran out, and sweeps up any worktrees
+    left behind on disk.
+    """
+    with sessions_lock:
+        thread_sessions.expire()
+        known_threads = set(thread_sessions)
+
     if not os.path.isdir(WORKTREES_DIR):
         return
 
     cutoff = time.time() - (max_age_hours * 3600)
 
-    for entry in os.listdir(WORKTREES_DIR):
-        entry_path = os.path.join(WORKTREES_DIR, entry)
-        if not os.path.isdir(entry_path):
-            continue
+    # scandir caches each entry's type from the directory read, so only the
+    # mtime needs a stat. Collect first; removing mid-scan mutates the dir.
+    stale = []
+    with os.scandir(WORKTREES_DIR) as it:
+        for entry in it:
+            if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                continue
 
-        # Reconstruct thread_ts from directory name
-        thread_ts = entry.replace("_", ".", 1)
+            # Reconstruct thread_ts from directory name
+            thread_ts = entry.name.replace("_", ".", 1)
 
-        if thread_ts in thread_sessions:
-            continue
+            if thread_ts in known_threads:
+                continue
 
-        try:
-            mtime = os.path.getmtime(entry_path)
-            if mtime > cutoff:
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                    continue
+            except OSError:
                 continue
-        except OSError:
-            continue
 
+            stale.append((thread_ts, entry.path))
+
+    for thread_ts, entry_path in stale:
         print(f"Cleaning up stale worktree: {entry_path}")
         remove_worktree(thread_ts)
 
-    subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "worktree", "prune"],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    request_prune()
 
 def cleanup_all_worktrees():
     """Remove all worktrees. Called on startup since thread_sessions is in-memory."""
@@ -170,19 +335,15 @@ def cleanup_all_worktrees():
         os.makedirs(WORKTREES_DIR, exist_ok=True)
         return
 
-    for entry in os.listdir(WORKTREES_DIR):
-        entry_path = os.path.join(WORKTREES_DIR, entry)
-        if os.path.isdir(entry_path):
-            subprocess.run(
-                ["sudo", "-u", CLAUDE_USER, "git", "worktree", "remove",
-                 "--force", entry_path],
-                capture_output=True, text=True, cwd=WORKSPACE_DIR
-            )
+    with os.scandir(WORKTREES_DIR) as it:
+        entry_paths = [entry.path for entry in it
+                       if not entry.name.startswith(".")
+                       and entry.is_dir(follow_symlinks=False)]
 
-    subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "worktree", "prune"],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    for entry_path in entry_paths:
+        run_git(["worktree", "remove", "--force", entry_path])
+
+    request_prune()
     print("Cleaned up all worktrees from previous run")
 
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
@@ -195,6 +356,107 @@ WORKSPACE_DIR = os.environ.get("WORKSPACE_DIR", "/home/claude-bot/workspace")
 WORKTREES_DIR = os.environ.get("WORKTREES_DIR", "/home/claude-bot/worktrees")
 DEFAULT_BRANCH = "main"
 CLAUDE_USER = "claude-bot"
+DEBUG = os.environ.get("LOG_LEVEL", "").upper() == "DEBUG"
+
+# Keyed once at startup; each request copies it rather than re-deriving the key
+SIGNING_HMAC = hmac.new((SLACK_SIGNING_SECRET or "").encode(), digestmod=hashlib.sha256)
+
+# Environment passed through to claude, built once rather than per run
+CLAUDE_ENV = {
+    var_name: var_value for var_name, var_value in [
+        ("ANTHROPIC_API_KEY", ANTHROPIC_API_KEY),
+        ("GH_TOKEN", GH_TOKEN),
+        ("ATLASSIAN_API_TOKEN", ATLASSIAN_API_TOKEN),
+        ("ATLASSIAN_USER", ATLASSIAN_USER),
+    ] if var_value
+}
+
+def running_as_claude_user():
+    """True if this process already runs as CLAUDE_USER (e.g. systemd User=)."""
+    try:
+        return os.geteuid() == pwd.getpwnam(CLAUDE_USER).pw_uid
+    except KeyError:
+        return False
+
+# A minimal bot-user environment for processes not launched through sudo.
+# Never inherit ours: it holds SLACK_BOT_TOKEN and SLACK_SIGNING_SECRET, and
+# claude runs arbitrary Bash (as can git hooks in the workspace).
+BOT_USER_ENV = {
+    "PATH": os.environ.get("PATH", "/usr/local/bin:/usr/bin:/bin"),
+    "HOME": os.path.expanduser(f"~{CLAUDE_USER}"),
+    "USER": CLAUDE_USER,
+    "LOGNAME": CLAUDE_USER,
+}
+CLAUDE_CHILD_ENV = {**BOT_USER_ENV, **CLAUDE_ENV}
+
+# When already running as the bot user, git and claude are exec'd directly
+# with the minimal environments above; otherwise each call hops through sudo,
+# which resets the environment itself.
+RUNNING_AS_CLAUDE_USER = running_as_claude_user()
+if RUNNING_AS_CLAUDE_USER:
+    GIT_COMMAND = ["git"]
+    GIT_ENV = BOT_USER_ENV
+    CLAUDE_COMMAND = ["claude"]
+    CLAUDE_COMMAND_ENV = CLAUDE_CHILD_ENV
+else:
+    GIT_COMMAND = ["sudo", "-u", CLAUDE_USER, "git"]
+    GIT_ENV = None
+    # sudo resets the environment, so the variables go on its command line
+    CLAUDE_COMMAND = [
+        "sudo", *(f"{k}={v}" for k, v in CLAUDE_ENV.items()),
+        "-u", CLAUDE_USER, "claude"
+    ]
+    CLAUDE_COMMAND_ENV = None
+
+# As root on a systemd host, each claude process instead runs in its own
+# transient scope as the bot user: memory is capped per process, and stopping
+# the scope kills everything claude spawned, so nothing is left orphaned.
+CLAUDE_MEMORY_MAX = "2G"
+_claude_scope_usable = None
+_claude_scope_lock = threading.Lock()
+
+def claude_scope_usable():
+    """Whether claude can be launched in a systemd scope, checked once.
+
+    Requires root on a host booted with systemd, and a trial systemd-run
+    that succeeds. Otherwise launches fall back to CLAUDE_COMMAND.
+    """
+    global _claude_scope_usable
+    with _claude_scope_lock:
+        if _claude_scope_usable is None:
+            _claude_scope_usable = probe_claude_scope()
+        return _claude_scope_usable
+
+def probe_claude_scope():
+    if os.geteuid() != 0 or RUNNING_AS_CLAUDE_USER:
+        return False
+    if not os.path.isdir("/run/systemd/system") or shutil.which("systemd-run") is None:
+        return False
+    try:
+        result = subprocess.run(
+            ["systemd-run", "--quiet", "--scope", f"--uid={CLAUDE_USER}", "true"],
+            capture_output=True, text=True, timeout=30
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"systemd-run unusable, launching claude without a scope: {e}")
+        return False
+    if result.returncode != 0:
+        print(f"systemd-run unusable, launching claude without a scope: {result.stderr.strip()}")
+        return False
+    return True
+
+# Share one keep-alive connection pool to slack.com across all Slack calls
+# instead of paying a TCP+TLS handshake per request.
+SLACK_SESSION = requests.Session()
+SLACK_SESSION.headers["Authorization"] = f"Bearer {SLACK_BOT_TOKEN}"
+SLACK_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+SLACK_TIMEOUT = (3, 10)  # (connect, read) seconds
+
+# Slack calls whose response isn't needed are sent from here so workers
+# (and the request handler) don't wait on the network.
+SLACK_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="slack"
+)
 
 def verify_slack_request():
     """Verify the request came from Slack using the signing secret."""
@@ -213,60 +475,303 @@ def verify_slack_request():
     if abs(time.time() - int(timestamp)) > 60 * 5:
         return False
 
-    # Compute the signature
-    sig_basestring = f"v0:{timestamp}:{request.get_data(as_text=True)}"
-    computed_signature = "v0=" + hmac.new(
-        SLACK_SIGNING_SECRET.encode(),
-        sig_basestring.encode(),
-        hashlib.sha256
-    ).hexdigest()
+    # Compute the signature over the raw body bytes (cached for request.json)
+    body = request.get_data(cache=True)
+    sig_basestring = b"v0:" + timestamp.encode() + b":" + body
+    mac = SIGNING_HMAC.copy()
+    mac.update(sig_basestring)
+    computed_signature = b"v0=" + mac.hexdigest().encode()
 
     # Compare signatures using constant-time comparison to prevent timing attacks
-    return hmac.compare_digest(computed_signature, slack_signature)
-
-def post_to_slack(channel, thread_ts, text):
-    resp = requests.post(
-        "https://slack.com/api/chat.postMessage",
-        headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-        json={
-            "channel": channel,
-            "thread_ts": thread_ts,
-            "text": text
-        }
-    )
-    data = resp.json()
+    return hmac.compare_digest(computed_signature, slack_signature.encode())
+
+def slack_api(method, payload):
+    """Call a Slack Web API method and return the decoded response.
+
+    Returns an empty dict if the request fails, so a Slack outage degrades
+    to missing messages rather than crashing the worker.
+    """
+    try:
+        resp = SLACK_SESSION.post(
+            f"https://slack.com/api/{method}",
+            json=payload,
+            timeout=SLACK_TIMEOUT
+        )
+        return resp.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"Slack {method} failed: {e}")
+        return {}
+
+def slack_api_async(method, payload):
+    """Queue a Slack API call on SLACK_EXECUTOR without waiting for it."""
+    SLACK_EXECUTOR.submit(slack_api, method, payload)
+
+def post_to_slack(channel, thread_ts, text, wait=True):
+    """Post a message to a thread.
+
+    Returns the new message's ts, or None when wait=False sends it in the
+    background.
+    """
+    payload = {
+        "channel": channel,
+        "thread_ts": thread_ts,
+        "text": text
+    }
+    if not wait:
+        slack_api_async("chat.postMessage", payload)
+        return None
+    data = slack_api("chat.postMessage", payload)
     return data.get("ts")  # message timestamp, used for chat.update
 
-def update_slack_message(channel, message_ts, text):
+def update_slack_message(channel, message_ts, text, wait=True):
     """Update an existing Slack message in-place."""
-    requests.post(
-        "https://slack.com/api/chat.update",
-        headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-        json={
-            "channel": channel,
-            "ts": message_ts,
-            "text": text
-        }
-    )
+    payload = {
+        "channel": channel,
+        "ts": message_ts,
+        "text": text
+    }
+    if not wait:
+        slack_api_async("chat.update", payload)
+        return
+    slack_api("chat.update", payload)
 
 def add_reaction(channel, timestamp, emoji):
-    """Add an emoji reaction to a message."""
-    requests.post(
-        "https://slack.com/api/reactions.add",
-        headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-        json={
-            "channel": channel,
-            "timestamp": timestamp,
-            "name": emoji
+    """Add an emoji reaction to a message in the background."""
+    slack_api_async("reactions.add", {
+        "channel": channel,
+        "timestamp": timestamp,
+        "name": emoji
+    })
+
+# Keep one long-lived claude process per Slack thread (see ClaudeSession).
+# Key: thread_ts, Value: ClaudeSession
+claude_sessions = {}
+claude_sessions_lock = threading.Lock()
+CLAUDE_IDLE_TIMEOUT = 15 * 60  # seconds before an idle session is closed
+
+class ClaudeSession:
+    """A long-lived `claude` process serving every turn of one Slack thread.
+
+    Starting the CLI costs several seconds of startup and auth, so instead of
+    forking per message the process runs in stream-json input mode and each
+    task is written to its stdin as a user message. A turn ends with a
+    `result` event, after which the process waits for the next message.
+    """
+
+    def __init__(self, thread_ts, cwd, allowed_tools, resume_session_id=None):
+        self.thread_ts = thread_ts
+        self.cwd = cwd
+        self.allowed_tools = allowed_tools
+        self.busy = True
+        self.last_used = time.time()
+        self.timed_out = False
+        self._stderr_tail = collections.deque(maxlen=50)
+
+        self.scope_unit = None
+        if claude_scope_usable():
+            self.scope_unit = f"claude-{sanitize_thread_ts(thread_ts)}-{time.monotonic_ns()}"
+            cmd = [
+                "systemd-run", "--quiet", "--scope",
+                f"--unit={self.scope_unit}",
+                f"--uid={CLAUDE_USER}",
+                f"--property=MemoryMax={CLAUDE_MEMORY_MAX}",
+                "--property=TimeoutStopSec=60",
+                "claude"
+            ]
+            # systemd-run --uid doesn't reset the environment the way sudo does
+            env = CLAUDE_CHILD_ENV
+        else:
+            cmd = list(CLAUDE_COMMAND)
+            env = CLAUDE_COMMAND_ENV
+
+        # Resume the thread's conversation if a previous process ended
+        if resume_session_id:
+            cmd.extend(["--resume", resume_session_id])
+
+        cmd.extend([
+                "-p",
+                "--input-format", "stream-json",
+                "--output-format", "stream-json",
+                "--allowedTools", allowed_tools,
+                "--verbose",
+                "--dangerously-skip-permissions"
+        ])
+
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=env
+        )
+        # Pipes are binary: stream-json lines go straight to orjson as bytes.
+        # Drain stderr continuously so a chatty process can't fill the pipe
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
+
+    def _drain_stderr(self):
+        for line in self.process.stderr:
+            self._stderr_tail.append(line.decode(errors="replace"))
+
+    @property
+    def stderr_output(self):
+        return "".join(self._stderr_tail).strip()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def _stop(self):
+        """Kill the process, and with a scope everything it spawned too."""
+        if not self.scope_unit:
+            # SIGTERM (not SIGKILL) so sudo forwards it to claude
+            self.process.terminate()
+            return
+        try:
+            subprocess.run(
+                ["systemctl", "stop", f"{self.scope_unit}.scope"],
+                capture_output=True, timeout=90
+            )
+        except subprocess.TimeoutExpired:
+            print(f"Timed out stopping {self.scope_unit}.scope")
+
+    def _kill_hung_turn(self):
+        self.timed_out = True
+        self._stop()
+
+    def send(self, task):
+        """Send a task and return an iterator over the events of its turn.
+
+        Raises OSError (e.g. BrokenPipeError) if the process has died and
+        can't accept the message.
+        """
+        message = {
+            "type": "user",
+            "message": {"role": "user", "content": [{"type": "text", "text": task}]}
         }
-    )
+        self.process.stdin.write(orjson.dumps(message) + b"\n")
+        self.process.stdin.flush()
+        return self._read_turn()
+
+    def _read_turn(self):
+        """Yield stream-json events until the turn's `result` event.
+
+        Stops early if the process exits. A turn running longer than
+        CLAUDE_TIMEOUT kills the process.
+        """
+        self.timed_out = False
+        watchdog = threading.Timer(CLAUDE_TIMEOUT, self._kill_hung_turn)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            for line in self.process.stdout:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                yield event
+                if event.get("type") == "result":
+                    return
+        finally:
+            watchdog.cancel()
+
+    def release(self):
+        """Mark the session idle so the reaper may close it later."""
+        self.busy = False
+        self.last_used = time.time()
+
+    def close(self):
+        """Stop the process, letting it exit cleanly on stdin EOF first.
+
+        A scope is always stopped, which also reaps anything claude left
+        running after it exited.
+        """
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                pass
+
+        if self.scope_unit or self.process.poll() is None:
+            self._stop()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+def get_claude_session(thread_ts, cwd, allowed_tools, resume_session_id=None):
+    """Return a busy ClaudeSession for the thread, starting one if needed.
+
+    The thread's existing process is reused only if it is still running in
+    the same directory with the same tools. At most MAX_CLAUDE_PROCESSES are
+    kept alive; the least recently used idle session makes room.
+    """
+    stale = []
+    with claude_sessions_lock:
+        session = claude_sessions.get(thread_ts)
+        if (session and session.is_alive() and session.cwd == cwd
+                and session.allowed_tools == allowed_tools):
+            session.busy = True
+            return session
+        if session:
+            stale.append(claude_sessions.pop(thread_ts))
+
+        idle = sorted((s for s in claude_sessions.values() if not s.busy),
+                      key=lambda s: s.last_used)
+        while len(claude_sessions) >= MAX_CLAUDE_PROCESSES and idle:
+            stale.append(claude_sessions.pop(idle.pop(0).thread_ts))
+
+        session = ClaudeSession(thread_ts, cwd, allowed_tools, resume_session_id)
+        claude_sessions[thread_ts] = session
+
+    for old in stale:
+        old.close()
+    return session
+
+def close_claude_session(thread_ts):
+    """Close the thread's Claude process, if it has one."""
+    with claude_sessions_lock:
+        session = claude_sessions.pop(thread_ts, None)
+    if session:
+        session.close()
+
+def reap_idle_claude_sessions():
+    """Close Claude processes that exited or sat idle past CLAUDE_IDLE_TIMEOUT."""
+    cutoff = time.time() - CLAUDE_IDLE_TIMEOUT
+    with claude_sessions_lock:
+        stale = [s for s in claude_sessions.values()
+                 if not s.busy and (s.last_used < cutoff or not s.is_alive())]
+        for session in stale:
+            del claude_sessions[session.thread_ts]
+
+    for session in stale:
+        print(f"Closing idle Claude session for thread {session.thread_ts}")
+        session.close()
 
 def run_claude(task, channel, thread_ts, message_ts):
-    global claude_process_count
+    """WORKER_POOL entry point: run the task, then release its process slot.
 
-    if not task or not task.strip():
+    The slot is claimed when the event is admitted. Releasing it here on
+    every exit path means an exception can't leak it.
+    """
+    global claude_process_count
+    try:
+        run_claude_task(task, channel, thread_ts, message_ts)
+    except Exception as e:
+        print(f"Claude run failed for thread {thread_ts}: {e}")
+    finally:
         with claude_lock:
             claude_process_count -= 1
+
+def run_claude_task(task, channel, thread_ts, message_ts):
+    if not task or not task.strip():
         return
 
     # Prevent concurrent runs in the same thread (they'd share a worktree)
@@ -274,72 +779,61 @@ def run_claude(task, channel, thread_ts, message_ts):
         if thread_ts in active_threads:
             post_to_slack(channel, thread_ts,
                 "I'm still working on the previous request in this thread. "
-                "Please wait for me to finish.")
-            with claude_lock:
-                claude_process_count -= 1
+                "Please wait for me to finish.", wait=False)
             return
         active_threads.add(thread_ts)
 
     add_reaction(channel, message_ts, "thumbsup")
 
     print(f"Running task: {task}")
-    print(f"Current thread_sessions: {json.dumps(thread_sessions, indent=2)}")
+    if DEBUG:
+        dump = orjson.dumps(dict(snapshot_thread_sessions()), option=orjson.OPT_INDENT_2).decode()
+        print(f"Current thread_sessions: {dump}")
+    with sessions_lock:
+        # Purge an expired entry now, while this thread is claimed in
+        # active_threads, so its release can't remove a worktree in use
+        thread_sessions.expire()
+        thread_info = thread_sessions.get(thread_ts, {})
 
     # Reuse existing worktree if the thread already has one, otherwise
     # just run in the main workspace in read-only mode.  A worktree is
     # only created when the user explicitly requests a branch via !branch.
-    thread_info = thread_sessions.get(thread_ts, {})
+    # Runs without a worktree store WORKSPACE_DIR here, which isn't one.
     worktree_path = thread_info.get("worktree_path")
-    has_worktree = bool(worktree_path and os.path.isdir(worktree_path))
+    has_worktree = bool(worktree_path and worktree_path != WORKSPACE_DIR
+                        and os.path.isdir(worktree_path))
     if has_worktree:
         print(f"Reusing existing worktree at {worktree_path} for thread {thread_ts}")
     else:
         worktree_path = WORKSPACE_DIR
         print(f"Using main workspace {worktree_path} (read-only, no worktree) for thread {thread_ts}")
 
+    session = None
+    final_result = None
+    completed = False
     try:
-        cmd = ["sudo"]
-        # Pass environment variables through sudo to claude-bot
-        for var_name, var_value in [
-            ("ANTHROPIC_API_KEY", ANTHROPIC_API_KEY),
-            ("GH_TOKEN", GH_TOKEN),
-            ("ATLASSIAN_API_TOKEN", ATLASSIAN_API_TOKEN),
-            ("ATLASSIAN_USER", ATLASSIAN_USER),
-        ]:
-            if var_value:
-                cmd.append(f"{var_name}={var_value}")
-        cmd.extend(["-u", CLAUDE_USER, "claude"])
-
-        # Resume existing session if this thread has one (must come before -p)
-        if thread_info.get("session_id"):
-            cmd.extend(["--resume", thread_info["session_id"]])
-
         # Full tools on a worktree branch; read-only on main workspace
         allowed_tools = "Bash,Read,Write,Edit" if has_worktree else "Bash,Read"
 
-        cmd.extend([
-                "-p", task,
-                "--allowedTools", allowed_tools,
-                "--output-format", "stream-json",
-                "--verbose",
-                "--dangerously-skip-permissions"
-        ])
-
         # Post initial thinking message and get its ts for live updates
         bot_msg_ts = post_to_slack(channel, thread_ts,
                                    ":hourglass_flowing_sand: Thinking...")
 
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=worktree_path,
-            stdin=subprocess.DEVNULL
-        )
+        session = get_claude_session(thread_ts, worktree_path, allowed_tools,
+                                     thread_info.get("session_id"))
+
+        try:
+            events = session.send(task)
+        except OSError:
+            # The process died between turns; start a new one resuming the
+            # conversation and try once more.
+            print(f"Claude process for thread {thread_ts} died, restarting")
+            close_claude_session(thread_ts)
+            session = get_claude_session(thread_ts, worktree_path, allowed_tools,
+                                         thread_info.get("session_id"))
+            events = session.send(task)
 
         session_id = None
-        final_result = None
         response_text = ""
         tool_history = []       # list of tool names used so far
         current_status = ""     # what's currently happening
@@ -378,15 +872,7 @@ def run_claude(task, channel, thread_ts, message_ts):
                 last_display = display
                 last_update = now
 
-        for line in process.stdout:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                event = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-
+        for event in events:
             event_type = event.get("type")
 
             if event_type == "system":
@@ -429,49 +915,54 @@ def run_claude(task, channel, thread_ts, message_ts):
                 session_id = event.get("session_id", session_id)
                 final_result = event.get("result", "")
 
-        process.wait()
-        stderr_output = process.stderr.read() if process.stderr else ""
-
-        if process.returncode != 0 and not final_result:
-            print(f"Claude process failed (rc={process.returncode}): {stderr_output}")
-            message = final_result or response_text or stderr_output or "Something went wrong."
+        if final_result is None and session.timed_out:
+            print(f"Claude process timed out after {CLAUDE_TIMEOUT}s for thread {thread_ts}")
+            message = f"{response_text}\n\n:warning: Timed out after {CLAUDE_TIMEOUT // 60} minutes."
+        elif final_result is None:
+            stderr_output = session.stderr_output
+            print(f"Claude process exited mid-turn (rc={session.process.poll()}): {stderr_output}")
+            message = response_text or stderr_output or "Something went wrong."
         else:
             message = final_result or response_text or "Done, but no output."
 
         # Store session for conversation continuity
         if session_id:
             current_branch = get_current_branch(worktree_path)
-            thread_sessions[thread_ts] = {
-                "session_id": session_id,
-                "branch": current_branch,
-                "worktree_path": worktree_path
-            }
+            with sessions_lock:
+                thread_sessions[thread_ts] = {
+                    "session_id": session_id,
+                    "branch": current_branch,
+                    "worktree_path": worktree_path
+                }
             print(f"Stored session {session_id}, branch {current_branch}, "
                   f"worktree {worktree_path} for thread {thread_ts}")
 
-        # Final update with complete response
+        # Final update with complete response. Sent in the background so the
+        # process slot is released as soon as Claude is done; earlier progress
+        # updates were synchronous, so this one can't be overtaken by them.
         message = markdown_to_slack(message)
-        print(f"Sending to Slack: {message[:200]}")
-        update_slack_message(channel, bot_msg_ts, message)
+        if DEBUG:
+            print(f"Sending to Slack: {message}")
+        update_slack_message(channel, bot_msg_ts, message, wait=False)
+        completed = True
     finally:
+        if session:
+            if final_result is None or not completed:
+                # The turn didn't finish cleanly, so its remaining output may
+                # still be unread; the next message must not pick it up.
+                close_claude_session(thread_ts)
+            else:
+                session.release()
         with active_threads_lock:
             active_threads.discard(thread_ts)
-        with claude_lock:
-            claude_process_count -= 1
 
 def update_main_branch():
     """Checkout and pull the main branch in the base workspace."""
-    checkout = subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "checkout", DEFAULT_BRANCH],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    checkout = run_git(["checkout", DEFAULT_BRANCH])
     if checkout.returncode != 0:
         return f"Failed to checkout `{DEFAULT_BRANCH}`: {checkout.stderr.strip()}"
 
-    pull = subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "pull"],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    pull = run_git(["pull"])
     if pull.returncode != 0:
         return f"Checked out `{DEFAULT_BRANCH}` but pull failed: {pull.stderr.strip()}"
 
@@ -483,24 +974,42 @@ def setup_branch(thread_ts, branch):
     If the thread already has a worktree, removes it first.
     If the branch doesn't exist, creates it from the default branch.
     """
-    # Remove existing worktree for this thread if any
-    thread_info = thread_sessions.get(thread_ts, {})
-    if thread_info.get("worktree_path") and os.path.isdir(thread_info["worktree_path"]):
-        remove_worktree(thread_ts)
+    # Claim the thread like a Claude run does: a run in progress is using the
+    # worktree, and the claim stops an expired entry's release from removing
+    # the worktree built here.
+    with active_threads_lock:
+        if thread_ts in active_threads:
+            return ("I'm still working on a request in this thread. "
+                    "Try `!branch` again once I'm done.")
+        active_threads.add(thread_ts)
+
+    try:
+        return setup_branch_worktree(thread_ts, branch)
+    finally:
+        with active_threads_lock:
+            active_threads.discard(thread_ts)
+
+def setup_branch_worktree(thread_ts, branch):
+    # The thread's Claude process runs inside the old worktree; the next
+    # message starts a fresh one there, resuming the same conversation.
+    close_claude_session(thread_ts)
+
+    # Purge an expired entry while the thread is claimed (see setup_branch)
+    with sessions_lock:
+        thread_sessions.expire()
+
+    # Remove the thread's existing worktree, if any. Go by the directory
+    # rather than thread_sessions, which may have forgotten an old one.
+    if not remove_worktree(thread_ts):
+        return "Failed to remove this thread's existing worktree."
 
     # Check if the branch exists
-    check = subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "rev-parse", "--verify", branch],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    check = run_git(["rev-parse", "--verify", branch])
     branch_exists = check.returncode == 0
 
     if not branch_exists:
         # Also check remote
-        check_remote = subprocess.run(
-            ["sudo", "-u", CLAUDE_USER, "git", "rev-parse", "--verify", f"origin/{branch}"],
-            capture_output=True, text=True, cwd=WORKSPACE_DIR
-        )
+        check_remote = run_git(["rev-parse", "--verify", f"origin/{branch}"])
         branch_exists = check_remote.returncode == 0
 
     try:
@@ -510,19 +1019,19 @@ def setup_branch(thread_ts, branch):
 
     # If the branch didn't exist, create it inside the worktree
     if not branch_exists:
-        create = subprocess.run(
-            ["sudo", "-u", CLAUDE_USER, "git", "checkout", "-b", branch],
-            capture_output=True, text=True, cwd=worktree_path
-        )
+        create = run_git(["checkout", "-b", branch], cwd=worktree_path)
         if create.returncode != 0:
             return f"Worktree created but failed to create branch `{branch}`: {create.stderr.strip()}"
 
-    # Update thread_sessions
-    thread_sessions[thread_ts] = {
-        "session_id": thread_info.get("session_id", ""),
-        "branch": branch,
-        "worktree_path": worktree_path
-    }
+    # Update thread_sessions, re-reading the session_id under the lock in
+    # case a Claude run stored a newer one while the worktree was built
+    with sessions_lock:
+        session_id = thread_sessions.get(thread_ts, {}).get("session_id", "")
+        thread_sessions[thread_ts] = {
+            "session_id": session_id,
+            "branch": branch,
+            "worktree_path": worktree_path
+        }
 
     if branch_exists:
         return f"Worktree ready on existing branch `{branch}`"
@@ -532,17 +1041,14 @@ def setup_branch(thread_ts, branch):
 def cleanup_branches():
     """Delete local branches that aren't the default and aren't tied to active sessions."""
     # Get all local branches
-    result = subprocess.run(
-        ["sudo", "-u", CLAUDE_USER, "git", "branch", "--format=%(refname:short)"],
-        capture_output=True, text=True, cwd=WORKSPACE_DIR
-    )
+    result = run_git(["branch", "--format=%(refname:short)"])
     if result.returncode != 0:
         return f"Failed to list branches: {result.stderr.strip()}"
 
     all_branches = [b.strip() for b in result.stdout.strip().splitlines() if b.strip()]
 
     # Branches in use by active sessions
-    active_branches = {info.get("branch") for info in thread_sessions.values() if info.get("branch")}
+    active_branches = {info.get("branch") for _, info in snapshot_thread_sessions() if info.get("branch")}
     active_branches.add(DEFAULT_BRANCH)
 
     to_delete = [b for b in all_branches if b not in active_branches]
@@ -553,10 +1059,7 @@ def cleanup_branches():
     deleted = []
     failed = []
     for branch in to_delete:
-        res = subprocess.run(
-            ["sudo", "-u", CLAUDE_USER, "git", "branch", "-D", branch],
-            capture_output=True, text=True, cwd=WORKSPACE_DIR
-        )
+        res = run_git(["branch", "-D", branch])
         if res.returncode == 0:
             deleted.append(branch)
         else:
@@ -577,14 +1080,16 @@ def format_status_message():
     with active_threads_lock:
         active = list(active_threads)
 
+    snapshot = snapshot_thread_sessions()
+
     lines = [f"*Claude Processes:* {running}/{MAX_CLAUDE_PROCESSES}"]
 
-    if not thread_sessions:
+    if not snapshot:
         lines.append("No active threads.")
     else:
-        lines.append(f"*Threads:* {len(thread_sessions)}")
-        for thread_ts, info in thread_sessions.items():
-            is_active = thread_ts in active_threads
+        lines.append(f"*Threads:* {len(snapshot)}")
+        for thread_ts, info in snapshot:
+            is_active = thread_ts in active
             status_icon = ":large_green_circle:" if is_active else ":white_circle:"
             branch = info.get("branch", "unknown")
             lines.append(f"  {status_icon} `{thread_ts}` — branch: `{branch}`")
@@ -601,14 +1106,14 @@ def status():
         active = list(active_threads)
 
     sessions = {}
-    for thread_ts, info in thread_sessions.items():
+    for thread_ts, info in snapshot_thread_sessions():
         worktree_path = info.get("worktree_path", "")
         sessions[thread_ts] = {
             "session_id": info.get("session_id", ""),
             "branch": info.get("branch", ""),
             "worktree_path": worktree_path,
             "worktree_exists": os.path.isdir(worktree_path) if worktree_path else False,
-            "active": thread_ts in active_threads,
+            "active": thread_ts in active,
         }
 
     return {
@@ -618,135 +1123,93 @@ def status():
         "threads": sessions,
     }
 
-@app.route("/slack/events", methods=["POST"])
-def slack_events():
-    # Verify the request is from Slack
-    if not verify_slack_request():
-        abort(401, "Invalid request signature")
+# Built-in `!` commands, handled by the app instead of Claude.
+# Handlers take (task, thread_ts) and return the reply text.
+COMMANDS = {
+    "!status": lambda task, thread_ts: format_status_message(),
+    "!update": lambda task, thread_ts: update_main_branch(),
+    "!cleanup-branches": lambda task, thread_ts: cleanup_branches(),
+}
+
+def handle_command(task, channel, thread_ts):
+    """Run the task as a built-in command if it is one. Returns True if handled."""
+    cmd = task.lower()
+    handler = COMMANDS.get(cmd)
+    if handler is None and cmd.startswith("!branch "):
+        handler = lambda task, thread_ts: setup_branch(thread_ts, task.split(None, 1)[1])
+    if handler is None:
+        return False
 
-    data = request.json
+    COMMAND_POOL.submit(run_command, handler, task, channel, thread_ts)
+    return True
 
-    # Slack URL verification challenge
-    if data.get("type") == "url_verification":
-        return data["challenge"]
+def run_command(handler, task, channel, thread_ts):
+    """COMMAND_POOL entry point: run a built-in command and post its reply."""
+    try:
+        reply = handler(task, thread_ts)
+    except Exception as e:
+        print(f"Command {task!r} failed for thread {thread_ts}: {e}")
+        reply = f"Command failed: {e}"
+    post_to_slack(channel, thread_ts, reply, wait=False)
+
+def start_task(task, channel, thread_ts, message_ts):
+    """Handle a mention or DM: run a built-in command or queue a Claude run."""
+    global claude_process_count
+
+    # Ignore empty messages (e.g. just "@bot" with no text)
+    if not task:
+        return
+
+    if handle_command(task, channel, thread_ts):
+        return
+
+    # Check if we've hit the max concurrent processes
+    with claude_lock:
+        if claude_process_count >= MAX_CLAUDE_PROCESSES:
+            post_to_slack(channel, thread_ts, "Busy right now boss", wait=False)
+            return
+        claude_process_count += 1
 
-    event = data.get("event", {})
+    # Run in background so we respond to Slack quickly
+    WORKER_POOL.submit(run_claude, task, channel, thread_ts, message_ts)
 
+def handle_event(event):
+    """Process one Slack event taken off EVENT_QUEUE."""
     # Ignore bot messages and message edits (avoid loops from chat.update)
     if event.get("bot_id"):
-        return "ok"
+        return
     if event.get("subtype") in ("message_changed", "message_deleted", "bot_message"):
-        return "ok"
+        return
 
-    global claude_process_count
     if event.get("type") == "app_mention":
+        # Strip the @mention
+        task = " ".join(event.get("text", "").split()[1:]).strip()
+    elif event.get("type") == "message" and event.get("channel_type") == "im":
+        # No need to strip @mention in DMs
+        task = event.get("text", "").strip()
+    else:
+        return
 
-        text = event.get("text", "")
-        channel = event["channel"]
-        message_ts = event["ts"]
-        thread_ts = event.get("thread_ts", message_ts)
+    message_ts = event["ts"]
+    thread_ts = event.get("thread_ts", message_ts)
+    start_task(task, event["channel"], thread_ts, message_ts)
 
-        # Check if we've hit the max concurrent processes
-        with claude_lock:
-            if claude_process_count >= MAX_CLAUDE_PROCESSES:
-                post_to_slack(channel, thread_ts, "Busy right now boss")
-                return "ok"
-            claude_process_count += 1
+@app.route("/slack/events", methods=["POST"])
+def slack_events():
+    # Verify the request is from Slack
+    if not verify_slack_request():
+        abort(401, "Invalid request signature")
 
-        # Strip the @mention
-        task = " ".join(text.split()[1:]).strip()
-
-        # Ignore empty mentions (just "@bot" with no text)
-        if not task:
-            with claude_lock:
-                claude_process_count -= 1
-            return "ok"
-
-        # Handle built-in commands before spawning Claude
-        cmd = task.lower()
-        if cmd == "!status":
-            with claude_lock:
-                claude_process_count -= 1
-            post_to_slack(channel, thread_ts, format_status_message())
-            return "ok"
-        if cmd == "!update":
-            with claude_lock:
-                claude_process_count -= 1
-            post_to_slack(channel, thread_ts, update_main_branch())
-            return "ok"
-        if cmd.startswith("!branch "):
-            with claude_lock:
-                claude_process_count -= 1
-            branch_name = task.split(None, 1)[1]
-            post_to_slack(channel, thread_ts, setup_branch(thread_ts, branch_name))
-            return "ok"
-        if cmd == "!cleanup-branches":
-            with claude_lock:
-                claude_process_count -= 1
-            post_to_slack(channel, thread_ts, cleanup_branches())
-            return "ok"
-
-        # Run in background so we respond to Slack quickly
-        threading.Thread(
-            target=run_claude,
-            args=(task, channel, thread_ts, message_ts)
-        ).start()
-
-        return "ok"
-
-    # Handle direct messages
-    if event.get("type") == "message" and event.get("channel_type") == "im":
-        text = event.get("text", "")
-        channel = event["channel"]
-        message_ts = event["ts"]
-        thread_ts = event.get("thread_ts", message_ts)
+    data = request.json
 
-        with claude_lock:
-            if claude_process_count >= MAX_CLAUDE_PROCESSES:
-                post_to_slack(channel, thread_ts, "Busy right now boss")
-                return "ok"
-            claude_process_count += 1
+    # Slack URL verification challenge
+    if data.get("type") == "url_verification":
+        return data["challenge"]
 
-        # No need to strip @mention in DMs
-        task = text.strip()
-
-        # Ignore empty messages
-        if not task:
-            with claude_lock:
-                claude_process_count -= 1
-            return "ok"
-
-        # Handle built-in commands before spawning Claude
-        cmd = task.lower()
-        if cmd == "!status":
-            with claude_lock:
-                claude_process_count -= 1
-            post_to_slack(channel, thread_ts, format_status_message())
-            return "ok"
-        if cmd == "!update":
-            with claude_lock:
-                claude_process_count -= 1
-            post_to_slack(channel, thread_ts, update_main_branch())
-            return "ok"
-        if cmd.startswith("!branch "):
-            with claude_lock:
-                claude_process_count -= 1
-            branch_name = task.split(None, 1)[1]
-            post_to_slack(channel, thread_ts, setup_branch(thread_ts, branch_name))
-            return "ok"
-        if cmd == "!cleanup-branches":
-            with claude_lock:
-                claude_process_count -= 1
-            post_to_slack(channel, thread_ts, cleanup_branches())
-            return "ok"
-
-        threading.Thread(
-            target=run_claude,
-            args=(task, channel, thread_ts, message_ts)
-        ).start()
-        return "ok"
-
-    return "ok"
+    # Acknowledge right away and leave the work to the dispatcher thread;
+    # Slack re-delivers events it hasn't seen a 200 for within 3 seconds.
+    EVENT_QUEUE.put(data.get("event", {}))
+    return "", 200
 
 def start_cleanup_timer(interval_hours=6):
     """Start a repeating background timer for worktree cleanup."""
@@ -761,7 +1224,63 @@ def start_cleanup_timer(interval_hours=6):
     t = threading.Thread(target=_cleanup, daemon=True)
     t.start()
 
+def start_prune_timer(interval_seconds=PRUNE_INTERVAL):
+    """Start a background thread that runs requested worktree prunes."""
+    def _prune():
+        while True:
+            time.sleep(interval_seconds)
+            if not _prune_pending.is_set():
+                continue
+            try:
+                prune_worktrees()
+            except Exception as e:
+                print(f"Worktree prune error: {e}")
+
+    t = threading.Thread(target=_prune, daemon=True)
+    t.start()
+
+def start_event_dispatcher():
+    """Start the thread that admits queued Slack events in arrival order."""
+    def _dispatch():
+        while True:
+            event = EVENT_QUEUE.get()
+            try:
+                handle_event(event)
+            except Exception as e:
+                print(f"Event dispatch error: {e}")
+
+    t = threading.Thread(target=_dispatch, daemon=True)
+    t.start()
+
+def start_session_reaper(interval_seconds=60):
+    """Start a background thread that closes idle Claude processes."""
+    def _reap():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                reap_idle_claude_sessions()
+            except Exception as e:
+                print(f"Session reaper error: {e}")
+
+    t = threading.Thread(target=_reap, daemon=True)
+    t.start()
+
+def start_background_threads():
+    """Start the dispatcher and the periodic cleanup threads."""
+    start_event_dispatcher()
+    start_cleanup_timer()
+    start_prune_timer()
+    start_session_reaper()
+
+# Started at import, not under __main__, so the app works however it is loaded:
+# /slack/events acknowledges events before handling them, so without these they
+# would silently pile up, and idle Claude processes would never be reaped.
+start_background_threads()
+
 if __name__ == "__main__":
     cleanup_all_worktrees()
-    start_cleanup_timer()
-    app.run(host="0.0.0.0", port=80)
+    # Waitress drops X-Forwarded-* from untrusted peers by default, which would
+    # hide Cloudflare's X-Forwarded-Proto from require_https; pass it through
+    # like the Flask dev server did.
+    serve(app, host="0.0.0.0", port=80, threads=HTTP_THREADS,
+          clear_untrusted_proxy_headers=False)